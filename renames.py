@@ -1,36 +1,68 @@
 #!/usr/bin/python3
-import requests, os, sys, re, subprocess, sqlite3, re, argparse
+import requests, os, sys, re, subprocess, sqlite3, re, argparse, atexit
 import pygit2 as git
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from itertools import groupby, chain
+from contextlib import contextmanager
+from functools import lru_cache
 from concurrent.futures import ProcessPoolExecutor, as_completed
 
-HASH_PATTERN = re.compile(r"Git-commit:[ \t]*([0-9a-f]{9,40})[ \t]*")
+HASH_PATTERN_B = re.compile(rb"Git-commit:[ \t]*([0-9a-f]{9,40})")
 CVE_PATTERN = re.compile(r"CVE-[0-9]{4}-[0-9]{4,}")
-CMD = f'log --oneline --raw --no-merges'
 BRANCHES_CONF = 'https://kerncvs.suse.de/branches.conf'
 MERGES_PATTERN = re.compile(r'[ \t]merge:-?([^ ]+)')
+TAG_SPLIT_PATTERN = re.compile(r'[.-]')
 BRANCH_BLACKLIST = ['vanilla', 'linux-next']
 DB_NAME = 'changes.sqlite'
 BIG_BANG = '1da177e4c3f41524e886b7f1b8a0c1fc7321cac2'
 BLACKLIST = 'Dell Inc.,XPS 13 9300' # weird file with spaces nobody gives a fig about
+RENAME_LIMIT = 100000 # libgit2 stops pairing renames above ~1000 files, big tree moves must stay renames
+SQLITE_MAX_VARIABLE_NUMBER = 999 # the lowest limit sqlite was ever compiled with
+
+_CONN = None
+
+def get_conn():
+    global _CONN
+    if _CONN is None:
+        # autocommit mode, transactions are opened explicitly in transaction()
+        _CONN = sqlite3.connect(DB_NAME, isolation_level=None)
+        _CONN.executescript('''
+        PRAGMA journal_mode = WAL;
+        PRAGMA synchronous = NORMAL;
+        PRAGMA temp_store = MEMORY;
+        PRAGMA foreign_keys = ON;
+        PRAGMA cache_size = -200000;
+        ''')
+        atexit.register(_CONN.close)
+    return _CONN
+
+@contextmanager
+def transaction():
+    conn = get_conn()
+    conn.execute('BEGIN')
+    try:
+        yield conn
+    except:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
 
 def create_db():
-    with sqlite3.connect(DB_NAME) as conn:
-        conn.execute('PRAGMA foreign_keys = ON')
-        conn.executescript('''
+    get_conn().executescript('''
         CREATE TABLE IF NOT EXISTS branches (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT UNIQUE NOT NULL,
+        name TEXT NOT NULL,
         ancestors INTEGER NOT NULL,
         tag_id INTEGER NOT NULL,
         FOREIGN KEY (tag_id) REFERENCES tags(id)
         );
 
-        CREATE TABLE IF NOT EXISTS tags (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL);
+        CREATE TABLE IF NOT EXISTS tags (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL);
 
-        CREATE TABLE IF NOT EXISTS commits (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL);
+        CREATE TABLE IF NOT EXISTS commits (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL);
 
-        CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL);
+        CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL);
 
         CREATE TABLE IF NOT EXISTS backports (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -137,56 +169,78 @@ def create_db():
         ;
         ''')
 
+def create_indexes():
+    # names are unique, but the indexes are built only once the bulk load is done
+    get_conn().executescript('''
+    CREATE UNIQUE INDEX IF NOT EXISTS branches_name ON branches(name);
+    CREATE UNIQUE INDEX IF NOT EXISTS tags_name ON tags(name);
+    CREATE UNIQUE INDEX IF NOT EXISTS commits_name ON commits(name);
+    CREATE UNIQUE INDEX IF NOT EXISTS files_name ON files(name);
+    ''')
+
 def store_array_into_db(query, array):
-    with sqlite3.connect(DB_NAME) as conn:
-        conn.execute('PRAGMA foreign_keys = ON')
-        cursor = conn.cursor()
-        cursor.executemany(query, array)
-        conn.commit()
+    with transaction() as conn:
+        conn.executemany(query, array)
+
+def bulk_insert(conn, table, cols, rows, verb='insert'):
+    rows = list(rows)
+    chunk_size = SQLITE_MAX_VARIABLE_NUMBER // len(cols)
+    row = '(' + ', '.join('?' * len(cols)) + ')'
+    head = f'{verb} into {table} ({", ".join(cols)}) VALUES '
+    full = len(rows) - len(rows) % chunk_size
+    if full:
+        conn.executemany(head + ', '.join([row] * chunk_size),
+                         (tuple(chain.from_iterable(rows[i:i + chunk_size])) for i in range(0, full, chunk_size)))
+    if full < len(rows):
+        conn.execute(head + ', '.join([row] * (len(rows) - full)), tuple(chain.from_iterable(rows[full:])))
+
+def store_bulk_into_db(table, cols, rows, verb='insert'):
+    with transaction() as conn:
+        bulk_insert(conn, table, cols, rows, verb)
 
 def do_query(query):
-    with sqlite3.connect(DB_NAME) as conn:
-        conn.execute('PRAGMA foreign_keys = ON')
-        cursor = conn.cursor()
-        return [ x for x in cursor.execute(query) ]
+    return [ x for x in get_conn().execute(query) ]
 
-def get_commits():
-    return { x for (x,) in do_query('SELECT name FROM commits;') }
+def update_ids(ids, table):
+    # ids are AUTOINCREMENT, so only rows inserted since the last update are fetched
+    last = max(ids[table].values(), default=0)
+    ids[table].update({ name: id for id, name in get_conn().execute(f'SELECT id, name FROM {table} WHERE id > ?', (last,)) })
+
+def resolve_changes(many, ids):
+    commit_ids, file_ids, tag_ids = ids['commits'], ids['files'], ids['tags']
+    return [ (commit_ids[h], score, file_ids.get(f), file_ids.get(t), tag_ids.get(tag)) for h, score, f, t, tag in many ]
 
 def store_tags_into_db(uniq_tags):
     many = [(t,) for t in uniq_tags]
     query = 'insert into tags (name) VALUES (?)'
     store_array_into_db(query, many)
 
-def store_branches_into_db(tags, number_of_ancestors):
-    many = [(k, number_of_ancestors[k], f'v{v}') for k, v in tags.items()]
-    query = 'insert into branches (name, ancestors, tag_id) VALUES (?, ?, (select id from tags where name = ?))'
+def store_branches_into_db(tags, number_of_ancestors, tag_ids):
+    many = [(k, number_of_ancestors[k], tag_ids.get(f'v{v}')) for k, v in tags.items()]
+    query = 'insert into branches (name, ancestors, tag_id) VALUES (?, ?, ?)'
     store_array_into_db(query, many)
 
 def store_commits_into_db(many):
-    query = 'insert into commits (name) VALUES (?)'
-    store_array_into_db(query, many)
+    store_bulk_into_db('commits', ('name',), many)
 
 def store_files_into_db(many):
-    query = 'insert or ignore into files (name) VALUES (?)'
-    store_array_into_db(query, many)
+    store_bulk_into_db('files', ('name',), many, 'insert or ignore')
 
 def store_changes_into_db(many):
-    query = '''insert into changes (commit_id, score, from_id, to_id, tag_id) VALUES (
-    (select id from commits where name = ?),
-    ?,
-    (select id from files where name = ?),
-    (select id from files where name = ?),
-    (select id from tags where name = ?)
-    )'''
-    store_array_into_db(query, many)
+    store_bulk_into_db('changes', ('commit_id', 'score', 'from_id', 'to_id', 'tag_id'), many)
 
 def store_backports_into_db(many):
-    query = '''insert into backports (commit_id, branch_id) VALUES (
-    (select id from commits where name = ?),
-    (select id from branches where name = ?)
-    )'''
-    store_array_into_db(query, many)
+    # stage (sha, branch) pairs and let sqlite resolve both ids in a single join
+    with transaction() as conn:
+        conn.execute('CREATE TEMP TABLE tmp_bp (sha TEXT, branch TEXT)')
+        bulk_insert(conn, 'tmp_bp', ('sha', 'branch'), many)
+        conn.execute('''insert into backports (commit_id, branch_id)
+        SELECT c.id, br.id
+        FROM tmp_bp
+        JOIN commits c ON c.name = tmp_bp.sha
+        JOIN branches br ON br.name = tmp_bp.branch
+        ''')
+        conn.execute('DROP TABLE tmp_bp')
 
 class Db:
     def __init__(self):
@@ -204,57 +258,67 @@ class Db:
                 break
         print(self.commits_by_id[v[2]], " ", self.tags_by_id[v[3]])
 
-def get_renames_with_score_or_none(l):
-    rr = l.split(' ')[4].split('\t')
-    if rr[0].startswith('R'):
-        return (rr[0], rr[1], rr[2])
-    if rr[0].startswith('A'):
-        return ('add', rr[1])
-    if rr[0].startswith('D'):
-        return ('del', rr[1])
+def get_renames_with_score_or_none(delta):
+    f, t = delta.old_file.path, delta.new_file.path
+    if BLACKLIST in f or BLACKLIST in t:
+        return None
+    if delta.status == git.GIT_DELTA_RENAMED:
+        return (delta.similarity, f, t)
+    if delta.status == git.GIT_DELTA_ADDED:
+        return (None, None, t)
+    if delta.status == git.GIT_DELTA_DELETED:
+        return (None, f, None)
     return None
 
-def get_hash(l, repo):
-    return repo.revparse_single(l.split(' ')[0]).id
+def get_tags_by_commit(uniq_tags, lpath):
+    ret = {}
+    for first, second in zip(uniq_tags, uniq_tags[1:]):
+        cmd = ['git', '-C', lpath, 'rev-list', f'{first}..{second}']
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=1 << 20) as proc:
+            for l in proc.stdout:
+                ret[l.rstrip(b'\n').decode('ascii')] = second
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return ret
 
-def between(begin, end, lpath):
+def between(first_tag, end, lrepo, tags_by_commit):
+    # one pass over the whole history, commits not in tags_by_commit are older than first_tag
     many = []
-    core_cmd = f'git -C {lpath} ' + CMD
-    if begin:
-        cmd = f'{core_cmd} {begin}..{end}'
-    else:
-        cmd = f'{core_cmd} {end}'
-    print(cmd, file=sys.stderr)
-    res = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-    lrepo = git.Repository(lpath)
-    hash = None
-    for l in res.stdout.decode('utf-8', 'ignore').split('\n'):
-        if not l or l.startswith(BIG_BANG[:12]):
-            break
-        if BLACKLIST in l:
+    commits, files = set(), set()
+    print(f'walking {end} in {lrepo.path}', file=sys.stderr)
+    for c in lrepo.walk(lrepo.revparse_single(end).peel(git.Commit).id, git.GIT_SORT_TOPOLOGICAL):
+        # no merges, BIG_BANG is stored by fetch_root_tree_files
+        if len(c.parents) > 1:
+            continue
+        hash = str(c.id)
+        if hash == BIG_BANG:
             continue
-        if l.startswith(':'):
-            r = get_renames_with_score_or_none(l)
-            if r and len(r) == 3:
-                many.append((str(hash), int(r[0][1:]), r[1], r[2], end))
-            elif r and len(r) == 2:
-                if r[0] == 'add':
-                    many.append((str(hash), None, None, r[1], end))
-                elif r[0] == 'del':
-                    many.append((str(hash), None, r[1], None, end))
+        tag = tags_by_commit.get(hash, first_tag)
+        if c.parents:
+            diff = c.parents[0].tree.diff_to_tree(c.tree)
         else:
-            hash = get_hash(l, lrepo)
-    commits = {(h,) for h, _, _, _, _ in many }
-    store_commits_into_db(list(commits))
-    filesx = [f for _, _, f, _, _ in many if f ]
-    filesy = [f for _, _, _, f, _ in many ]
-    files = {(f,) for f, _ in groupby(chain(filesx, filesy))}
-    return (files, many)
+            # other roots (merged unrelated histories) add their whole tree, like git log's showRoot
+            diff = c.tree.diff_to_tree(swap=True)
+        diff.find_similar(git.GIT_DIFF_FIND_RENAMES, rename_limit=RENAME_LIMIT)
+        for delta in diff.deltas:
+            r = get_renames_with_score_or_none(delta)
+            if r:
+                score, f, t = r
+                many.append((hash, score, f, t, tag))
+                commits.add(hash)
+                if f:
+                    files.add(f)
+                if t:
+                    files.add(t)
+    return ([(f,) for f in files], many, [(c,) for c in commits])
 
 def fetch_branches_conf():
     try:
-        data = requests.get(BRANCHES_CONF)
-        return data.text
+        with requests.Session() as session:
+            session.mount('https://', HTTPAdapter(max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])))
+            data = session.get(BRANCHES_CONF, timeout=(3.05, 15))
+            data.raise_for_status()
+            return data.text
     except requests.exceptions.HTTPError as http_err:
         print(f"HTTP error occurred: {http_err}", file=sys.stderr)
     except requests.exceptions.ConnectionError as conn_err:
@@ -270,7 +334,7 @@ def get_list_of_branches(branches_conf):
     for l in branches_conf.split('\n'):
         if not l or l.startswith('#') or l.startswith(' ') or ':' not in l or 'build' not in l:
             continue
-        branch_name = l.split(':')[0]
+        branch_name, _, _ = l.partition(':')
         if branch_name in BRANCH_BLACKLIST:
             continue
         ret[branch_name] = ret.get(branch_name, set())
@@ -293,21 +357,17 @@ def transitive_closure(branches):
     return { k: len(v) for k, v in branches.items() }
 
 def key_function(s):
-    arr = re.split(r'[.-]', s)[:3]
-    arr[0] = int(arr[0])
-    if len(arr) > 1:
-        arr[1] = int(arr[1])
-    if len(arr) > 2:
-        if arr[2].startswith('rc'):
-            arr[2] = int(arr[2][2:])
-        else:
-            arr[2] = int(arr[2])
-    return arr
+    arr = TAG_SPLIT_PATTERN.split(s, 3)
+    major = int(arr[0])
+    minor = int(arr[1]) if len(arr) > 1 else 0
+    third = arr[2] if len(arr) > 2 else '0'
+    patch = int(third[2:]) if third.startswith('rc') else int(third)
+    return (major, minor, patch)
 
 def extract_srcversion(content):
     for l in content.split('\n'):
         if l.startswith('SRCVERSION='):
-            return l.split('=')[1]
+            return l[len('SRCVERSION='):]
     return ''
 
 def get_tags_from_ksource_tree(branches, repo):
@@ -323,34 +383,78 @@ def get_tags_from_ksource_tree(branches, repo):
             print('#', b, file=sys.stderr)
     return ret
 
+# the same upstream commit is backported to many branches, resolve it only once
+@lru_cache(maxsize=1 << 17)
+def resolve_sha(lrepo, sha):
+    try:
+        return str(lrepo.revparse_single(sha).id)
+    except:
+        return None
+
 def get_hash_or_nothing(fc, lrepo):
-    for l in fc.split('\n'):
-        ps = re.findall(HASH_PATTERN, l)
-        if ps:
-            try:
-                return str(lrepo.revparse_single(ps[0]).id)
-            except:
-                return None
-    return None
+    # Git-commit: lives in the mail header, do not scan the diff below it
+    hdr_end = fc.find(b'\n\n')
+    m = HASH_PATTERN_B.search(fc, 0, len(fc) if hdr_end < 0 else hdr_end)
+    if not m:
+        return None
+    return resolve_sha(lrepo, m.group(1).decode('ascii'))
+
+def start_cat_file(path):
+    # one persistent git cat-file instead of materializing every blob through pygit2
+    return subprocess.Popen(['git', '-C', path, 'cat-file', '--batch=%(objectname) %(objecttype) %(objectsize)'],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+def cat_file_batch(proc, oids):
+    for oid in oids:
+        proc.stdin.write(f'{oid}\n'.encode('ascii'))
+        proc.stdin.flush()
+        header = proc.stdout.readline().split()
+        if len(header) != 3:
+            continue # <oid> missing
+        data = proc.stdout.read(int(header[2]))
+        proc.stdout.read(1) # trailing LF
+        yield data
+
+# per worker process repositories, pygit2 objects cannot be passed around
+# the git cat-file lives as long as the worker, it exits on EOF once the worker is gone
+_CAT_FILE = None
+_KREPO = None
+_LREPO = None
+
+def _init_worker(kpath, lpath):
+    global _CAT_FILE, _KREPO, _LREPO
+    _CAT_FILE = start_cat_file(kpath)
+    _KREPO = git.Repository(kpath)
+    _LREPO = git.Repository(lpath)
+
+def _branch_commits(b):
+    ret = []
+    try:
+        tree = _KREPO.revparse_single('origin/' + b).tree
+        if 'patches.suse' not in tree:
+            return (b, ret)
+        subtree = _KREPO[tree['patches.suse'].id]
+        patches_ids = [ e.id for e in subtree if e.type_str == 'blob' ]
+        for data in cat_file_batch(_CAT_FILE, patches_ids):
+            hs = get_hash_or_nothing(data, _LREPO)
+            if hs:
+                ret.append(hs)
+    except Exception as e:
+        print('#', b, e, file=sys.stderr)
+    return (b, ret)
 
-def get_commits_per_branch(branches, krepo, lrepo):
+def get_commits_per_branch(branches, kpath, lpath):
     ret = {}
-    for b in branches:
-        ret[b] = []
-        try:
-            tree = krepo.revparse_single('origin/' + b).tree
-            tree_index = git.Index()
-            tree_index.read_tree(tree)
-            patches_ids = [ t.id for t in tree_index if t.path.startswith('patches.suse/') ]
-            for pid in patches_ids:
-                hs = get_hash_or_nothing(krepo[pid].data.decode('utf8', 'ignore'), lrepo)
-                if hs:
-                    ret[b].append(hs)
-        except Exception as e:
-            print('#', b, e, file=sys.stderr)
+    # cpu_count() ignores affinity masks and cgroup cpusets
+    max_workers = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(kpath, lpath)) as executor:
+        futures = { executor.submit(_branch_commits, b) for b in branches }
+        for f in as_completed(futures):
+            b, hashes = f.result()
+            ret[b] = hashes
     return ret
 
-def fetch_root_tree_files(lrepo, tag):
+def fetch_root_tree_files(lrepo, tag, ids):
     tree_index = git.Index()
     try:
         tree_index.read_tree(lrepo.revparse_single(BIG_BANG).tree)
@@ -359,10 +463,9 @@ def fetch_root_tree_files(lrepo, tag):
         sys.exit(1)
     store_files_into_db([ (e.path,) for e in tree_index ])
     store_commits_into_db([(BIG_BANG,)])
-    store_changes_into_db([ (BIG_BANG, None, None, e.path, tag) for e in tree_index ])
-
-def prepare_tags_for_parallel_partition(uniq_tags):
-    return [('', uniq_tags[0])] + [ (f, s) for f, s in zip(uniq_tags, uniq_tags[1:]) ]
+    update_ids(ids, 'files')
+    update_ids(ids, 'commits')
+    store_changes_into_db(resolve_changes([ (BIG_BANG, None, None, e.path, tag) for e in tree_index ], ids))
 
 def fetch_cves(cves, branch):
     path_to_repo = os.getenv('VULNS_GIT', None)
@@ -392,7 +495,8 @@ def fetch_cves(cves, branch):
 
 
 def build_db():
-    os.path.isfile(DB_NAME) and os.rename(DB_NAME, DB_NAME + '.OLD')
+    for suffix in ('', '-wal', '-shm'):
+        os.path.isfile(DB_NAME + suffix) and os.rename(DB_NAME + suffix, DB_NAME + '.OLD' + suffix)
     create_db()
 
     branches_conf = fetch_branches_conf()
@@ -410,31 +514,34 @@ def build_db():
     pure_tags = [ 'v' + p for p in pure_tags ]
     uniq_tags = [ t for t, _ in groupby(pure_tags) ]
 
+    ids = { 'tags': {}, 'commits': {}, 'files': {} }
     store_tags_into_db(uniq_tags)
+    update_ids(ids, 'tags')
     uniq_tags.append('master')
     number_of_ancestors = transitive_closure(branches)
-    store_branches_into_db(tags, number_of_ancestors)
+    store_branches_into_db(tags, number_of_ancestors, ids['tags'])
 
     lpath = os.getenv('LINUX_GIT', None)
     if not lpath:
         print("Cannot get LINUX_GIT", file=sys.stderr)
     lrepo = git.Repository(lpath)
-    fetch_root_tree_files(lrepo, uniq_tags[0])
-
-    tag_pairs = prepare_tags_for_parallel_partition(uniq_tags)
-
-    with ProcessPoolExecutor() as executor:
-        futures = { executor.submit(between, first, second, lpath) for first, second in tag_pairs }
-        for f in as_completed(futures):
-            files, many = f.result()
-            store_files_into_db(files)
-            store_changes_into_db(many)
-
-    commits_per_branch = get_commits_per_branch(branches.keys(), krepo, lrepo)
-    commits = get_commits()
-    for branch, hashes in commits_per_branch.items():
-        backports = [(h, branch) for h in hashes if h in commits ]
-        store_backports_into_db(backports)
+    fetch_root_tree_files(lrepo, uniq_tags[0], ids)
+
+    tags_by_commit = get_tags_by_commit(uniq_tags, lpath)
+    files, many, commits = between(uniq_tags[0], uniq_tags[-1], lrepo, tags_by_commit)
+    store_commits_into_db(commits)
+    # no unique index to ignore duplicates against yet, skip the files of the root tree here
+    store_files_into_db([ f for f in files if f[0] not in ids['files'] ])
+    update_ids(ids, 'commits')
+    update_ids(ids, 'files')
+    store_changes_into_db(resolve_changes(many, ids))
+    create_indexes()
+
+    commits_per_branch = get_commits_per_branch(branches.keys(), kpath, lpath)
+    # ids['commits'] already knows every stored commit including BIG_BANG, only stage the ones that will join
+    commits = ids['commits']
+    store_backports_into_db([(h, branch) for branch, hashes in commits_per_branch.items() for h in hashes if h in commits ])
+    get_conn().execute('PRAGMA wal_checkpoint(TRUNCATE)')
 
 def is_valid_sha(sha):
     if len(sha) != 40: